@@ -1,37 +1,131 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
 from dotenv import load_dotenv
-from agents import Agent, Runner
-import logging, json, uvicorn
-from typing import Dict, Any
+from agents import Agent, AgentOutputSchema, ModelSettings, RunConfig, Runner, set_default_openai_client
+from openai import AsyncOpenAI, RateLimitError
+from openai.types.responses import ResponseTextDeltaEvent
+import asyncio, httpx, logging, orjson, os, re, uvicorn
+from cachetools import TTLCache
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from hashlib import blake2b
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
 # ---------------------------------------------------------------------------
 # ENV & LOGGING
 # ---------------------------------------------------------------------------
 load_dotenv()
-logging.basicConfig(level=logging.INFO)
+
+# Set once per request (from X-Request-ID or a fresh id); tasks spawned for the
+# request inherit it, so every log line and LLM call can be correlated
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+# A client id ends up in every log line and in headers sent to OpenAI, so
+# anything else is replaced with a fresh one
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+def accept_request_id(header: Optional[str]) -> str:
+    return header if header and REQUEST_ID_RE.fullmatch(header) else uuid4().hex
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(levelname)s:%(name)s:[%(request_id)s] %(message)s",
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger("tripbot")
 
+def run_config() -> RunConfig:
+    # X-Client-Request-Id is OpenAI's header for a caller‑supplied id;
+    # accept_request_id() keeps ours within its limits
+    return RunConfig(model_settings=ModelSettings(extra_headers={"X-Client-Request-Id": request_id.get()}))
+
 # ---------------------------------------------------------------------------
-# Pydantic model for the fabricated offer (human‑friendly fields)
+# Pydantic models for TripBot's reply and the fabricated offer (human‑friendly fields)
 # ---------------------------------------------------------------------------
 class Offer(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     airline: str
     flight_number: str
+    departure_city: str
+    departure_country: str
     departure_time: str  # e.g. "2025‑07‑05T08:00"
+    arrival_city: str
+    arrival_country: str
     arrival_time:   str  # e.g. "2025‑07‑05T16:15"
     hotel_name: str
+    hotel_rating: float
     total_cost: float
     notes: str
 
+# TripBot's structured output; the model is constrained to this JSON schema
+class Reply(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    message: str
+    offer: Optional[Offer]  # null until all trip details are known
+
+# ---------------------------------------------------------------------------
+# Request body for /chat and /chat/stream
+# ---------------------------------------------------------------------------
+class ChatRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    user_id: str = "guest"
+    message: str = ""
+
+# ---------------------------------------------------------------------------
+# OpenAI client: every agent run shares one pool of warm HTTP/2 connections
+# ---------------------------------------------------------------------------
+openai_client = AsyncOpenAI(
+    # Fail fast on a dead connection, but leave room for long generations
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+)
+set_default_openai_client(openai_client)
+
 # ---------------------------------------------------------------------------
 # FastAPI setup
 # ---------------------------------------------------------------------------
-app = FastAPI()
+# Local stand‑in for fastapi.responses.ORJSONResponse, which is deprecated
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
-# Per‑user session memory: stores an agent plus chat history
-sessions: Dict[str, Dict[str, Any]] = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await openai_client.close()
+    if redis is not None:
+        await redis.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Serialises turns of the same user within this worker so history/summary
+# updates don't interleave (see turn_lock for Redis mode); a user's lock is
+# dropped as soon as no turn holds or awaits it
+session_locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+
+def session_lock(uid: str) -> asyncio.Lock:
+    lock = session_locks.get(uid)
+    if lock is None:
+        lock = session_locks[uid] = asyncio.Lock()
+    return lock
 
 AGENT_PROMPT = (
     "You are **TripBot**, a friendly travel assistant.\n\n"
@@ -43,47 +137,301 @@ AGENT_PROMPT = (
     "total_cost = 250 + 3*100 = 550.\n"
     "Use user_points at $0.01/pt toward total_cost; mention points used inside notes if relevant.\n\n"
     "If you still need info →\n"
-    "{\n  \"message\": \"I still need your departure city…\",\n  \"offer\": {}\n}\n\n"
+    "{\n  \"message\": \"I still need your departure city…\",\n  \"offer\": null\n}\n\n"
     "If you have enough info →\n"
     "{\n  \"message\": \"Here is your offer!\",\n  \"offer\": {\n    \"airline\": \"BudgetAir\",\n    \"flight_number\": \"BA123\",\n    \"departure_city\": \"Los Angeles\",\n    \"departure_country\": \"USA\",\n    \"departure_time\": \"2025‑07‑05T08:00\",\n    \"arrival_city\":   \"New York\",\n    \"arrival_country\": \"USA\",\n    \"arrival_time\":   \"2025‑07‑05T16:15\",\n    \"hotel_name\":     \"Happy Stay Inn\",\n    \"hotel_rating\":   4.2,\n    \"total_cost\": 550,\n    \"notes\": \"Includes 3‑night stay; 30,000 points applied.\"\n  }\n}"
 )
 
+# The agent holds no per‑user state, so one instance serves every session
+# and the output schema (JSON schema + validator) is built once here too
+tripbot = Agent(
+    name="TripBot", instructions=AGENT_PROMPT, model="gpt-4o-mini",
+    output_type=AgentOutputSchema(Reply),
+)
+
+# ---------------------------------------------------------------------------
+# Rolling summary: only the last RECENT_TURNS exchanges are sent verbatim,
+# older ones are folded into a running summary stored in the session.
+# ---------------------------------------------------------------------------
+RECENT_TURNS = 6
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a chat between a traveller and TripBot.\n"
+    "Extend the summary with the new exchange. Keep every trip detail the user gave "
+    "(cities, dates, points budget) and any offer already made. Reply with the summary text only."
+)
+
+summarizer = Agent(name="Summarizer", instructions=SUMMARY_PROMPT, model="gpt-4o-mini")
+
+async def summarize(summary: str, dropped: List[str]) -> str:
+    prompt = f"Summary so far:\n{summary or '(empty)'}\n\nNew exchange:\n" + "\n".join(dropped)
+    try:
+        result = await Runner.run(summarizer, prompt, run_config=run_config())
+    except Exception as err:
+        # A failed summary must not fail the user's turn; keep the old one
+        logger.warning("Summary update failed: %s", err)
+        return summary
+    return str(result.final_output)
+
+# ---------------------------------------------------------------------------
+# Session store: Redis when REDIS_URL is set (shared by all workers, expires
+# after SESSION_TTL idle seconds), otherwise the in‑process `sessions` dict
+# ---------------------------------------------------------------------------
+REDIS_URL    = os.getenv("REDIS_URL")
+SESSION_TTL  = 3600
+MAX_SESSIONS = 10_000  # per process, in‑memory store and reply cache only
+
+# One pooled client per worker; REDIS_MAX_CONNECTIONS caps sockets per process.
+# redis is only imported when it is actually used.
+if REDIS_URL:
+    from redis.asyncio import Redis
+    redis = Redis.from_url(
+        REDIS_URL, decode_responses=True,
+        max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+    )
+else:
+    redis = None
+
+# Per‑user session memory (used when REDIS_URL is unset): chat history plus running summary
+sessions: TTLCache = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+
+def new_session() -> Dict[str, Any]:
+    return {"history": deque(maxlen=2 * RECENT_TURNS), "summary": ""}
+
+async def load_session(uid: str) -> Dict[str, Any]:
+    if redis is None:
+        return sessions.get(uid) or new_session()
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.lrange(f"sess:{uid}:hist", 0, -1)
+        pipe.get(f"sess:{uid}:summary")
+        history, summary = await pipe.execute()
+    return {"history": deque(history, maxlen=2 * RECENT_TURNS), "summary": summary or ""}
+
+async def record_turn(uid: str, session: Dict[str, Any], user_msg: str, assistant_reply: str) -> None:
+    # Appending to a full window evicts the exchange that was just summarised
+    history = session["history"]
+    history.append(user_msg)
+    history.append(assistant_reply)
+
+    if redis is None:
+        sessions[uid] = session  # re‑insert so the TTL counts from the last turn
+        return
+    # Push only the new exchange; LTRIM keeps Redis in step with the deque window
+    hist_key = f"sess:{uid}:hist"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(hist_key, user_msg, assistant_reply)
+        pipe.ltrim(hist_key, -2 * RECENT_TURNS, -1)
+        pipe.expire(hist_key, SESSION_TTL)
+        pipe.set(f"sess:{uid}:summary", session["summary"], ex=SESSION_TTL)
+        await pipe.execute()
+
+# With several workers the per‑process session_lock is not enough: two turns of
+# one user on different workers would both extend the same window and fold the
+# same dropped exchange into the summary. Redis mode therefore also holds a
+# per‑user lock (SET NX PX, released only by its owner). TURN_LOCK_TTL is an
+# upper bound on a turn, including the OpenAI client's retries, so a crashed
+# worker can't block the user for longer than that.
+TURN_LOCK_TTL = 300
+
+@asynccontextmanager
+async def turn_lock(uid: str) -> AsyncIterator[None]:
+    async with session_lock(uid):
+        if redis is None:
+            yield
+        else:
+            async with redis.lock(f"sess:{uid}:lock", timeout=TURN_LOCK_TTL, sleep=0.05):
+                yield
+
+# ---------------------------------------------------------------------------
+# Duplicate‑request guard: the same message re‑sent within REPLY_TTL seconds
+# (client retry, double click) gets the previous reply instead of a new LLM call.
+# The key includes the conversation as the request found it, so only a resend
+# that raced the original replays; the same words sent once the conversation
+# has moved on (a second "yes") start a new turn.
+# Kept in Redis next to the session when REDIS_URL is set, so a retry landing
+# on another worker still hits.
+# ---------------------------------------------------------------------------
+REPLY_TTL = 60
+
+# uid -> (turn key, payload) for the user's latest turn
+recent_replies: TTLCache = TTLCache(maxsize=MAX_SESSIONS, ttl=REPLY_TTL)
+
+async def last_reply(uid: str) -> str:
+    # Changes every turn, unlike the history length once the window is full
+    if redis is None:
+        session = sessions.get(uid)
+        return session["history"][-1] if session and session["history"] else ""
+    return await redis.lindex(f"sess:{uid}:hist", -1) or ""
+
+def message_key(msg: str, last_reply: str) -> str:
+    # A retry re‑sends the same bytes; "Yes" and "yes" are different messages
+    return blake2b(orjson.dumps([last_reply, msg]), digest_size=16).hexdigest()
+
+async def replayed_reply(uid: str, key: str) -> Optional[Dict[str, Any]]:
+    if redis is None:
+        cached = recent_replies.get(uid)
+    else:
+        raw = await redis.get(f"reply:{uid}")
+        cached = orjson.loads(raw) if raw is not None else None
+    if cached and cached[0] == key:
+        return cached[1]
+    return None
+
+async def remember_reply(uid: str, key: str, payload: Dict[str, Any]) -> None:
+    if redis is None:
+        recent_replies[uid] = (key, payload)
+    else:
+        await redis.set(f"reply:{uid}", orjson.dumps((key, payload)), ex=REPLY_TTL)
+
+def reply_payload(reply: Reply) -> Dict[str, Any]:
+    # Clients get {} rather than null while TripBot is still asking questions
+    return {"message": reply.message, "offer": reply.offer.model_dump() if reply.offer else {}}
+
+# ---------------------------------------------------------------------------
+# Backpressure: at most MAX_CONCURRENT turns per worker talk to the LLM at once.
+# Beyond that, and when the provider rate‑limits us (after the OpenAI client's
+# own backoff retries), answer 429 so clients back off instead of piling on.
+# ---------------------------------------------------------------------------
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "50"))
+llm_slots = asyncio.Semaphore(MAX_CONCURRENT)
+
+def retry_later(reason: str) -> ORJSONResponse:
+    return ORJSONResponse({"error": reason}, status_code=429, headers={"Retry-After": "1"})
+
+def sse_error(reason: str) -> bytes:
+    # /chat/stream's counterpart of retry_later once the 200 has been sent
+    return b"event: error\ndata: " + orjson.dumps({"error": reason}) + b"\n\n"
+
+@app.exception_handler(RateLimitError)
+async def rate_limited(request: Request, exc: RateLimitError):
+    logger.warning("OpenAI rate limit: %s", exc)
+    return retry_later("rate limited by the model provider")
+
+# ---------------------------------------------------------------------------
+# Turn handling shared by /chat and /chat/stream (call under turn_lock)
+# ---------------------------------------------------------------------------
+async def read_request(request: Request) -> Tuple[str, str]:
+    request_id.set(accept_request_id(request.headers.get("x-request-id")))
+    # Parsed and validated in one pass by pydantic-core, no intermediate dict;
+    # a malformed body is rejected before any session or LLM work
+    try:
+        req = ChatRequest.model_validate_json(await request.body())
+    except ValidationError as err:
+        raise HTTPException(400, [{"loc": e["loc"], "msg": e["msg"]} for e in err.errors()])
+    return req.user_id, req.message
+
+async def start_turn(uid: str, user_msg: str) -> Tuple[Dict[str, Any], str, List[str]]:
+    session = await load_session(uid)
+    history = session["history"]
+    summary = session["summary"]
+    prefix  = [f"Summary of earlier conversation: {summary}"] if summary else []
+    conversation = "\n".join([*prefix, *history, user_msg])
+
+    # Once the window is full the oldest exchange is still sent verbatim this
+    # turn and is folded into the summary alongside the reply (see summarising)
+    dropped = [history[0], history[1]] if len(history) == history.maxlen else []
+    return session, conversation, dropped
+
+@asynccontextmanager
+async def summarising(session: Dict[str, Any], dropped: List[str]) -> AsyncIterator[None]:
+    # The summary is only needed next turn, so it runs alongside the reply and
+    # is awaited on exit, still inside the turn's LLM slot; summarize() never
+    # raises, and the task is dropped if the reply fails
+    task = asyncio.create_task(summarize(session["summary"], dropped)) if dropped else None
+    try:
+        yield
+    except BaseException:
+        if task is not None:
+            task.cancel()
+        raise
+    if task is not None:
+        session["summary"] = await task
+
+async def finish_turn(uid: str, key: str, session: Dict[str, Any], user_msg: str, reply: Reply) -> Dict[str, Any]:
+    await record_turn(uid, session, user_msg, reply.model_dump_json())
+
+    payload = reply_payload(reply)
+    await remember_reply(uid, key, payload)
+    return payload
+
 # ---------------------------------------------------------------------------
 # /chat endpoint
 # ---------------------------------------------------------------------------
 @app.post("/chat")
 async def chat(request: Request):
-    data = await request.json()
-    uid = data.get("user_id", "guest")
-    user_msg = data.get("message", "")
+    uid, user_msg = await read_request(request)
+    # Taken before waiting on the lock, so a resend racing the original shares its key
+    key = message_key(user_msg, await last_reply(uid))
 
-    # Initialise session
-    if uid not in sessions:
-        sessions[uid] = {
-            "agent": Agent(name="TripBot", instructions=AGENT_PROMPT, model="gpt-4o-mini"),
-            "history": []
-        }
+    async with turn_lock(uid):
+        payload = await replayed_reply(uid, key)
+        if payload is None:
+            # Nothing is awaited between the check and taking the slot, so
+            # excess turns are turned away rather than queued on llm_slots
+            if llm_slots.locked():
+                return retry_later("server busy")
+            async with llm_slots:
+                session, conversation, dropped = await start_turn(uid, user_msg)
+                async with summarising(session, dropped):
+                    result = await Runner.run(tripbot, conversation, run_config=run_config())
+            payload = await finish_turn(uid, key, session, user_msg, result.final_output)
 
-    agent   = sessions[uid]["agent"]
-    history = sessions[uid]["history"]
+    return ORJSONResponse(payload)
 
-    conversation = "\n".join(history + [user_msg]) if history else user_msg
-    result = await Runner.run(agent, conversation)
-    assistant_reply = str(result.final_output)
-    history.extend([user_msg, assistant_reply])
+# ---------------------------------------------------------------------------
+# /chat/stream endpoint: same turn as /chat, sent as server‑sent events.
+# Each text delta is a `data:` frame (JSON‑encoded string); the parsed reply
+# follows as a final `event: done` frame.
+# ---------------------------------------------------------------------------
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    uid, user_msg = await read_request(request)
+    key = message_key(user_msg, await last_reply(uid))
+    # Best effort 429 while headers can still be sent; a duplicate that will be
+    # replayed needs no slot. The authoritative check is in events().
+    if llm_slots.locked() and await replayed_reply(uid, key) is None:
+        return retry_later("server busy")
 
-    try:
-        payload = json.loads(assistant_reply)
-        if "message" not in payload:
-            raise ValueError("missing message key")
-        if "offer" not in payload:
-            payload["offer"] = {}
-    except Exception as err:
-        logger.warning("Non‑JSON assistant reply: %s", err)
-        payload = {"message": assistant_reply, "offer": {}}
+    # Headers are already sent when this runs, so every outcome ends the stream
+    # with an in‑band frame: `done`, or `error` where /chat would send 429/500
+    async def events():
+        try:
+            async with turn_lock(uid):
+                payload = await replayed_reply(uid, key)
+                if payload is None:
+                    if llm_slots.locked():
+                        yield sse_error("server busy")
+                        return
+                    async with llm_slots:
+                        session, conversation, dropped = await start_turn(uid, user_msg)
+                        async with summarising(session, dropped):
+                            result = Runner.run_streamed(tripbot, conversation, run_config=run_config())
+                            async for event in result.stream_events():
+                                if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                                    yield b"data: " + orjson.dumps(event.data.delta) + b"\n\n"
+                    payload = await finish_turn(uid, key, session, user_msg, result.final_output)
+        except RateLimitError as err:
+            logger.warning("OpenAI rate limit: %s", err)
+            yield sse_error("rate limited by the model provider")
+            return
+        except Exception:
+            logger.exception("Streamed turn failed")
+            yield sse_error("internal error")
+            return
+        yield b"event: done\ndata: " + orjson.dumps(payload) + b"\n\n"
 
-    return JSONResponse(payload)
+    # Ask proxies (nginx) not to buffer or cache the stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
 
 # ---------------------------------------------------------------------------
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # Without REDIS_URL sessions live in this process, so keep WORKERS=1
+    # unless users are pinned to a worker (sticky load balancing)
+    uvicorn.run(
+        "app:app", host="0.0.0.0", port=5000,
+        workers=int(os.getenv("WORKERS", "1")),
+        loop="uvloop", http="httptools",
+        # ACCESS_LOG=0 skips per-request access-log formatting in production
+        access_log=os.getenv("ACCESS_LOG", "1") != "0",
+    )